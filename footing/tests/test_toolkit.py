@@ -0,0 +1,449 @@
+"""Tests for the footing.toolkit module"""
+import concurrent.futures
+import os
+import pathlib
+import time
+
+import pytest
+import yaml
+
+import footing.toolkit
+import footing.util
+
+
+@pytest.fixture
+def project_dir(tmp_path, monkeypatch):
+    """Run the test from an empty project directory"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def write_config(project_dir):
+    """Write the local footing config for the project"""
+
+    def _write_config(toolkits):
+        config_path = footing.util.local_config_path()
+        config_path.parent.mkdir(exist_ok=True, parents=True)
+        with open(config_path, "w") as f:
+            yaml.safe_dump({"project": {"name": "proj"}, "toolkits": toolkits}, f)
+
+    return _write_config
+
+
+def test_local_config(write_config, mocker):
+    """Tests footing.toolkit._local_config only re-parses the config when it changes"""
+    local_config = mocker.spy(footing.util, "local_config")
+    write_config([{"name": "dev", "manager": "conda", "tools": ["python"]}])
+
+    config = footing.toolkit._local_config()
+    assert [toolkit["name"] for toolkit in config["toolkits"]] == ["dev"]
+    assert local_config.call_count == 1
+
+    # Callers get copies, so changing one doesn't leak into later lookups
+    config["toolkits"][0]["tools"].append("git")
+    assert footing.toolkit._local_config()["toolkits"][0]["tools"] == ["python"]
+    assert footing.toolkit.Toolkit.from_name("dev").toolsets[0].tools == ["python"]
+    assert local_config.call_count == 1
+
+    # Rewriting the file re-parses it, even if the mtime happens to be unchanged
+    config_path = footing.util.local_config_path()
+    stat = config_path.stat()
+    write_config([{"name": "docs", "manager": "conda"}])
+    os.utime(config_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    config = footing.toolkit._local_config()
+    assert [toolkit["name"] for toolkit in config["toolkits"]] == ["docs"]
+    assert local_config.call_count == 2
+
+
+def test_local_config_missing(project_dir):
+    """Tests footing.toolkit._local_config without a config file"""
+    assert footing.toolkit._local_config() == {"toolkits": [], "artifacts": []}
+    assert footing.toolkit.Toolkit.from_default() is None
+
+
+def test_ref(project_dir, mocker):
+    """Tests footing.toolkit.Toolkit.ref is cached until its inputs change"""
+    (project_dir / "pyproject.toml").write_text("[project]\n")
+    toolkit = footing.toolkit.Toolkit(
+        name="dev",
+        toolsets=[footing.toolkit.Toolset(manager="pip", file="pyproject.toml")],
+        _def={"name": "dev"},
+    )
+    file_digest = mocker.spy(footing.toolkit, "_file_digest")
+
+    ref = toolkit.ref
+    assert len(ref) == 64
+    assert toolkit.ref == ref
+    assert file_digest.call_count == 1
+
+    # Changing the file invalidates the cached ref
+    (project_dir / "pyproject.toml").write_text("[project]\nname = 'proj'\n")
+    assert toolkit.ref != ref
+    assert file_digest.call_count == 2
+
+    # So does changing the definition or the platforms
+    ref = toolkit.ref
+    toolkit._def = {"name": "dev", "category": "prod"}
+    assert toolkit.ref != ref
+
+    ref = toolkit.ref
+    toolkit.platforms = ["linux-64"]
+    assert toolkit.ref != ref
+
+
+def test_ref_includes_base(project_dir):
+    """Tests footing.toolkit.Toolkit.ref changes with its base toolkits"""
+    base = footing.toolkit.Toolkit(name="_base", _def={"name": "_base"})
+    toolkit = footing.toolkit.Toolkit(name="dev", base=base, _def={"name": "dev"})
+
+    ref = toolkit.ref
+    base._def = {"name": "_base", "tools": ["python"]}
+    assert toolkit.ref != ref
+
+
+def test_flattened_toolkits_and_toolsets():
+    """Tests footing.toolkit.Toolkit.flattened_toolkits and flattened_toolsets"""
+    base_toolset = footing.toolkit.Toolset(manager="conda", tools=["python"])
+    dev_toolset = footing.toolkit.Toolset(manager="pip", tools=["pytest"])
+    base = footing.toolkit.Toolkit(name="_base", toolsets=[base_toolset])
+    lib = footing.toolkit.Toolkit(name="lib", base=base)
+    dev = footing.toolkit.Toolkit(name="dev", base=lib, toolsets=[dev_toolset])
+
+    assert [toolkit.name for toolkit in dev.flattened_toolkits] == ["_base", "lib", "dev"]
+    assert dev.flattened_toolsets == [base_toolset, dev_toolset]
+
+    # Changes anywhere in the chain are reflected
+    dev.base.base = footing.toolkit.Toolkit(name="x")
+    assert [toolkit.name for toolkit in dev.flattened_toolkits] == ["x", "lib", "dev"]
+    assert dev.flattened_toolsets == [dev_toolset]
+
+    lib_toolset = footing.toolkit.Toolset(manager="conda", tools=["git"])
+    lib.toolsets.append(lib_toolset)
+    assert dev.flattened_toolsets == [lib_toolset, dev_toolset]
+
+
+def test_dependency_specs_adds_pip():
+    """Tests footing.toolkit.Toolkit.dependency_specs installs pip for pip dependencies"""
+    toolkit = footing.toolkit.Toolkit(
+        name="dev",
+        toolsets=[
+            footing.toolkit.Toolset(manager="conda", tools=["python==3.10"]),
+            footing.toolkit.Toolset(manager="pip", tools=["Requests "]),
+        ],
+    )
+
+    specs = toolkit.dependency_specs
+    python_dep, requests_dep, pip_dep = [dep for spec in specs for dep in spec.dependencies]
+    assert (python_dep.name, python_dep.manager, python_dep.conda_channel) == (
+        "python",
+        "conda",
+        "conda-forge",
+    )
+    assert (requests_dep.name, requests_dep.manager) == ("requests", "pip")
+    assert (pip_dep.name, pip_dep.version, pip_dep.manager, pip_dep.conda_channel) == (
+        "pip",
+        "22.3.1",
+        "conda",
+        "conda-forge",
+    )
+
+    # The synthesized pip dependency doesn't share mutable state with python
+    assert pip_dep.selectors == python_dep.selectors
+    assert pip_dep.selectors is not python_dep.selectors
+    assert pip_dep.extras is not python_dep.extras
+
+
+@pytest.mark.parametrize(
+    "tools",
+    [
+        [["python==3.10"], ["pip"]],
+        [["python==3.10"], []],
+        [["git"], ["requests"]],
+    ],
+)
+def test_dependency_specs_without_pip(tools):
+    """Tests footing.toolkit.Toolkit.dependency_specs only adds pip when it's missing"""
+    conda_tools, pip_tools = tools
+    toolkit = footing.toolkit.Toolkit(
+        name="dev",
+        toolsets=[
+            footing.toolkit.Toolset(manager="conda", tools=conda_tools),
+            footing.toolkit.Toolset(manager="pip", tools=pip_tools),
+        ],
+    )
+
+    assert len(toolkit.dependency_specs) == 2
+
+
+def test_lock(project_dir, mocker):
+    """Tests footing.toolkit.Toolkit.lock merges the lock files of each platform"""
+    from conda_lock.src_parser import HashModel, LockedDependency, Lockfile, LockMeta
+    from conda_lock.src_parser.lockfile import parse_conda_lock_file, write_conda_lock_file
+
+    def _lock_platform(platform, output_path):
+        lockfile = Lockfile(
+            package=[
+                LockedDependency(
+                    name="python",
+                    version="3.10.0",
+                    manager="conda",
+                    platform=platform,
+                    dependencies={},
+                    url=f"https://conda.anaconda.org/conda-forge/{platform}/python.tar.bz2",
+                    hash=HashModel(md5="0" * 32),
+                )
+            ],
+            metadata=LockMeta(
+                content_hash={platform: "hash"},
+                channels=[],
+                platforms=[platform],
+                sources=[],
+            ),
+        )
+        write_conda_lock_file(lockfile, output_path, metadata_choices=None)
+
+    mocker.patch("footing.toolkit._lock_platform", side_effect=_lock_platform)
+    mocker.patch("conda_lock.src_parser.pyproject_toml.get_lookup")
+    toolkit = footing.toolkit.Toolkit(name="dev", platforms=["linux-64", "osx-arm64"])
+
+    toolkit.lock(project_dir / "conda-lock.yml")
+
+    lockfile = parse_conda_lock_file(project_dir / "conda-lock.yml")
+    assert lockfile.metadata.platforms == ["linux-64", "osx-arm64"]
+    assert lockfile.metadata.content_hash == {"linux-64": "hash", "osx-arm64": "hash"}
+    assert sorted((dep.name, dep.platform) for dep in lockfile.package) == [
+        ("python", "linux-64"),
+        ("python", "osx-arm64"),
+    ]
+
+
+def test_lock_parses_specs_once(project_dir, mocker):
+    """Tests footing.toolkit.Toolkit.lock parses specs before locking platforms in parallel"""
+    import conda_lock.conda_lock
+    from conda_lock.src_parser import pyproject_toml
+
+    (project_dir / "pyproject.toml").write_text(
+        '[project]\nname = "proj"\ndependencies = ["Requests"]\n'
+    )
+    normalize_pypi_name = pyproject_toml.normalize_pypi_name
+    real_parse_pyproject_toml = pyproject_toml.parse_pyproject_toml
+
+    def _parse_pyproject_toml(path):
+        # Widen the window in which concurrent parses would overlap
+        time.sleep(0.01)
+        return real_parse_pyproject_toml(path)
+
+    parse_pyproject_toml = mocker.patch(
+        "conda_lock.src_parser.pyproject_toml.parse_pyproject_toml",
+        side_effect=_parse_pyproject_toml,
+    )
+    mocker.patch("conda_lock.src_parser.pyproject_toml.get_lookup")
+    mocker.patch("conda_lock.src_parser.lockfile.parse_conda_lock_file")
+    mocker.patch("conda_lock.src_parser.lockfile.write_conda_lock_file")
+    locked_specs = []
+
+    def _lock_platform(platform, output_path):
+        specs = conda_lock.conda_lock.parse_source_files()
+        specs[0].dependencies[0].name = platform
+        locked_specs.append(specs)
+
+    mocker.patch("footing.toolkit._lock_platform", side_effect=_lock_platform)
+    toolkit = footing.toolkit.Toolkit(
+        name="dev",
+        toolsets=[footing.toolkit.Toolset(manager="pip", file="pyproject.toml")],
+        platforms=["linux-64", "osx-arm64", "osx-64"],
+    )
+
+    toolkit.lock(project_dir / "conda-lock.yml")
+
+    assert pyproject_toml.normalize_pypi_name is normalize_pypi_name
+    assert parse_pyproject_toml.call_count == 1
+
+    # Each platform locks its own copy of the specs
+    assert sorted(specs[0].dependencies[0].name for specs in locked_specs) == [
+        "linux-64",
+        "osx-64",
+        "osx-arm64",
+    ]
+    assert [dep.name for dep in toolkit.dependency_specs[0].dependencies] == ["requests"]
+
+
+def test_lock_platform(mocker):
+    """Tests footing.toolkit._lock_platform runs conda-lock for one platform"""
+    mocker.patch("footing.util.condabin_dir", return_value=pathlib.Path("/bin"))
+    mock_lock = mocker.patch("conda_lock.conda_lock.lock", autospec=True)
+
+    footing.toolkit._lock_platform("linux-64", "conda-lock.yml")
+
+    mock_lock.assert_called_once_with(
+        [
+            "--lockfile",
+            "conda-lock.yml",
+            "--mamba",
+            "--strip-auth",
+            "--conda",
+            "/bin/mamba",
+            "-p",
+            "linux-64",
+        ]
+    )
+
+
+@pytest.mark.parametrize("min_bytes, parallel", [(8 * 1024 * 1024, False), (0, True)])
+def test_ref_parallel_digest(min_bytes, parallel, project_dir, mocker):
+    """Tests footing.toolkit.Toolkit.ref only hashes files in parallel when they're large"""
+    (project_dir / "pyproject.toml").write_text("[project]\n")
+    (project_dir / "environment.yml").write_text("dependencies: []\n")
+    toolkit = footing.toolkit.Toolkit(
+        name="dev",
+        toolsets=[
+            footing.toolkit.Toolset(manager="pip", file="pyproject.toml"),
+            footing.toolkit.Toolset(manager="conda", file="environment.yml"),
+        ],
+        _def={"name": "dev"},
+    )
+    serial_ref = toolkit.ref
+
+    toolkit._ref_cache = None
+    mocker.patch("footing.toolkit._PARALLEL_DIGEST_MIN_BYTES", min_bytes)
+    executor = mocker.spy(footing.toolkit.concurrent.futures, "ThreadPoolExecutor")
+
+    assert toolkit.ref == serial_ref
+    assert executor.called == parallel
+
+
+@pytest.mark.parametrize(
+    "names, expected",
+    [
+        (["_base", "dev"], "dev"),
+        (["dev", "docs"], None),
+        (["dev", "docs", "default"], "default"),
+        (["_base"], None),
+        ([], None),
+    ],
+)
+def test_from_default(names, expected, write_config):
+    """Tests footing.toolkit.Toolkit.from_default"""
+    write_config([{"name": name, "manager": "conda"} for name in names])
+
+    toolkit = footing.toolkit.Toolkit.from_default()
+    assert (toolkit.name if toolkit else None) == expected
+
+
+def test_dependency_spec_cache(project_dir, mocker):
+    """Tests footing.toolkit.Toolset.dependency_spec is cached until its inputs change"""
+    from conda_lock.src_parser import LockSpecification, VersionedDependency
+
+    def _parse_environment_file(path, *args, **kwargs):
+        return LockSpecification(
+            channels=[],
+            dependencies=[
+                VersionedDependency(name=name, version="", manager="conda")
+                for name in path.read_text().split()
+            ],
+            platforms=[],
+            sources=[],
+        )
+
+    (project_dir / "environment.yml").write_text("python\n")
+    (project_dir / "environment.yaml").write_text("pandas\n")
+    parse_environment_file = mocker.patch(
+        "conda_lock.src_parser.environment_yaml.parse_environment_file",
+        side_effect=_parse_environment_file,
+    )
+    toolset = footing.toolkit.Toolset(manager="conda", file="environment.yml")
+
+    spec = toolset.dependency_spec
+    assert [dep.name for dep in spec.dependencies] == ["python"]
+    assert parse_environment_file.call_count == 1
+
+    # Cached specs are copies, so callers can't change the cache
+    spec.dependencies[0].name = "changed"
+    assert [dep.name for dep in toolset.dependency_spec.dependencies] == ["python"]
+    assert parse_environment_file.call_count == 1
+
+    # Changing the file or its contents invalidates the cache, even when the size and mtime match
+    stat = (project_dir / "environment.yml").stat()
+    os.utime(project_dir / "environment.yaml", ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    toolset.file = "environment.yaml"
+    assert [dep.name for dep in toolset.dependency_spec.dependencies] == ["pandas"]
+    assert parse_environment_file.call_count == 2
+
+    (project_dir / "environment.yaml").write_text("pandas\nmake\n")
+    assert [dep.name for dep in toolset.dependency_spec.dependencies] == ["pandas", "make"]
+    assert parse_environment_file.call_count == 3
+
+
+def test_from_name(write_config):
+    """Tests footing.toolkit.Toolkit.from_name resolves bases and prefers the first definition"""
+    write_config(
+        [
+            {"name": "_base", "manager": "conda", "tools": ["python"]},
+            {"name": "dev", "base": "_base", "manager": "pip", "tools": ["pytest"]},
+            {"name": "_base", "manager": "conda", "tools": ["git"]},
+        ]
+    )
+
+    toolkit = footing.toolkit.Toolkit.from_name("dev")
+    assert [toolkit.name for toolkit in toolkit.flattened_toolkits] == ["_base", "dev"]
+    assert [toolset.tools for toolset in toolkit.flattened_toolsets] == [["python"], ["pytest"]]
+    assert footing.toolkit.Toolkit.from_name("missing") is None
+
+
+def test_ls(write_config, mocker):
+    """Tests footing.toolkit.ls builds the toolkit index once"""
+    write_config(
+        [
+            {"name": "_base", "manager": "conda", "tools": ["python"]},
+            {"name": "dev", "base": "_base", "manager": "pip", "tools": ["pytest"]},
+            {"name": "docs", "base": "dev", "manager": "pip", "tools": ["sphinx"]},
+        ]
+    )
+    toolkits_by_name = mocker.spy(footing.toolkit, "_toolkits_by_name")
+
+    toolkits = footing.toolkit.ls()
+    assert [toolkit.name for toolkit in toolkits] == ["dev", "docs"]
+    assert [toolkit.name for toolkit in toolkits[1].flattened_toolkits] == [
+        "_base",
+        "dev",
+        "docs",
+    ]
+    assert toolkits_by_name.call_count == 1
+
+
+def test_dependency_spec_concurrent(project_dir, mocker):
+    """Tests footing.toolkit.Toolset.dependency_spec is safe to call from several threads"""
+    from conda_lock.src_parser import pyproject_toml
+
+    (project_dir / "pyproject.toml").write_text(
+        '[project]\nname = "proj"\ndependencies = ["Requests"]\n'
+    )
+    normalize_pypi_name = pyproject_toml.normalize_pypi_name
+    real_parse_pyproject_toml = pyproject_toml.parse_pyproject_toml
+    normalizers = []
+    mocker.patch("conda_lock.src_parser.pyproject_toml.get_lookup", return_value={})
+
+    def _parse_pyproject_toml(path):
+        # Widen the window in which concurrent parses would overlap
+        time.sleep(0.01)
+        normalizers.append(pyproject_toml.normalize_pypi_name)
+        return real_parse_pyproject_toml(path)
+
+    mocker.patch(
+        "conda_lock.src_parser.pyproject_toml.parse_pyproject_toml",
+        side_effect=_parse_pyproject_toml,
+    )
+    shared = footing.toolkit.Toolset(manager="pip", file="pyproject.toml")
+    toolsets = [shared, shared, shared] + [
+        footing.toolkit.Toolset(manager="pip", file="pyproject.toml") for _ in range(3)
+    ]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(toolsets)) as executor:
+        specs = list(executor.map(lambda toolset: toolset.dependency_spec, toolsets))
+
+    assert pyproject_toml.normalize_pypi_name is normalize_pypi_name
+    # The shared toolset is parsed once and every parse runs with the patched normalizer
+    assert len(normalizers) == 4
+    assert normalize_pypi_name not in normalizers
+    assert [[dep.name for dep in spec.dependencies] for spec in specs] == [["requests"]] * 6
@@ -0,0 +1,21 @@
+"""Tests for the footing.util module"""
+import pytest
+
+import footing.util
+
+
+def test_patch_attr():
+    """Tests footing.util.patch_attr"""
+
+    class Obj:
+        value = 1
+
+    with footing.util.patch_attr(Obj, "value", 2):
+        assert Obj.value == 2
+    assert Obj.value == 1
+
+    with pytest.raises(ValueError):
+        with footing.util.patch_attr(Obj, "value", 3):
+            assert Obj.value == 3
+            raise ValueError()
+    assert Obj.value == 1
@@ -1,28 +1,117 @@
+import concurrent.futures
 import contextlib
 import copy
 import dataclasses
+import functools
 import hashlib
+import operator
+import os
 import pathlib
+import sys
 import tempfile
+import threading
 import typing
-import unittest.mock
 
-import conda_lock.conda_lock
-from conda_lock.src_parser import environment_yaml, LockSpecification, pyproject_toml
 import yaml
 
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:  # pragma: no cover
+    from yaml import SafeDumper
+
 import footing.build
 import footing.registry
 import footing.util
 
+if typing.TYPE_CHECKING:  # pragma: no cover
+    from conda_lock.src_parser import LockSpecification
+
+
+# Slotted dataclasses are only available on Python 3.10+
+_dataclass_kwargs = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+# Dependencies that are always installed with conda, regardless of the toolset manager
+_CONDA_DEPENDENCIES = frozenset({"python", "pip"})
+
+# Toolset files are usually small, so only hash them in parallel when there is enough data
+# to outweigh the cost of starting threads
+_PARALLEL_DIGEST_MIN_BYTES = 8 * 1024 * 1024
+
+# Serializes parsing of toolset dependency specs across threads
+_dependency_spec_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1)
+def _cached_local_config(config_path, mtime_ns, size):
+    return footing.util.local_config(base_dir=config_path.parent.parent)
+
+
+def _local_config():
+    """Return the local config, only re-parsing it when the file changes"""
+    config_path = footing.util.local_config_path().resolve()
+    try:
+        stat = os.stat(config_path)
+    except FileNotFoundError:
+        return footing.util.local_config()
+
+    # Toolkits keep references into the config, so never hand out the cached dict itself
+    return copy.deepcopy(_cached_local_config(config_path, stat.st_mtime_ns, stat.st_size))
+
+
+def _toolkits_by_name(config):
+    """Index toolkit definitions by name. The first definition of a name wins"""
+    return {toolkit["name"]: toolkit for toolkit in reversed(config["toolkits"])}
+
+
+def _noop(*args, **kwargs):
+    pass
+
 
-@dataclasses.dataclass
+def _lock_platform(platform, output_path):
+    """Run conda-lock for a single platform"""
+    import conda_lock.conda_lock
+
+    conda_lock.conda_lock.lock(
+        [
+            "--lockfile",
+            str(output_path),
+            "--mamba",
+            "--strip-auth",
+            "--conda",
+            str(footing.util.condabin_dir() / "mamba"),
+            "-p",
+            platform,
+        ]
+    )
+
+
+def _blake2b():
+    return hashlib.blake2b(digest_size=32)
+
+
+def _file_digest(path):
+    """Compute the BLAKE2b digest of a file"""
+    with open(path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(f, _blake2b).digest()
+
+        h = _blake2b()
+        for chunk in iter(lambda: f.read(65536), b""):
+            h.update(chunk)
+
+        return h.digest()
+
+
+@dataclasses.dataclass(**_dataclass_kwargs)
 class Toolset:
     manager: str
-    tools: list = dataclasses.field(default_factory=list)
-    file: str = None
+    tools: typing.List[str] = dataclasses.field(default_factory=list)
+    file: typing.Optional[str] = None
+    _dependency_spec_cache: typing.Optional[tuple] = dataclasses.field(
+        default=None, init=False, repr=False, compare=False
+    )
 
-    def __post_init__(self):
+    def __post_init__(self) -> None:
         if self.manager not in ["conda", "pip"]:
             raise ValueError(f"Unsupported manager '{self.manager}'")
 
@@ -36,19 +125,17 @@ class Toolset:
         ):
             raise ValueError(f"Unsupported file '{self.file}'")
 
-    @property
-    def dependency_spec(self):
-        """Generate the dependency specification"""
+    def _parse_dependency_spec(self) -> "LockSpecification":
+        """Parse the dependency specification from the tools or file"""
+        from conda_lock.src_parser import environment_yaml, LockSpecification, pyproject_toml
+
         if self.file == "pyproject.toml":
             # For now, assume users aren't using conda-lock and ensure pyproject
             # requirements are always installed with pip.
             # TODO: Detect if using conda-lock and let conda-lock do its
             # pip->conda translation magic
 
-            with unittest.mock.patch(
-                "conda_lock.src_parser.pyproject_toml.normalize_pypi_name",
-                side_effect=lambda name: name,
-            ):
+            with footing.util.patch_attr(pyproject_toml, "normalize_pypi_name", lambda name: name):
                 spec = pyproject_toml.parse_pyproject_toml(pathlib.Path(self.file))
         elif self.file in ("environment.yaml", "environment.yml"):
             spec = environment_yaml.parse_environment_file(pathlib.Path(self.file))
@@ -67,18 +154,43 @@ class Toolset:
                 sources=[],
             )
 
+        # Conda dependencies default to conda-forge when the spec doesn't declare channels
+        needs_default_channel = not spec.channels
         for dep in spec.dependencies:
-            dep.name = dep.name.lower().strip()
-            dep.manager = self.manager if dep.name not in ("python", "pip") else "conda"
+            name = sys.intern(dep.name.strip().lower())
+            dep.name = name
+            dep.manager = self.manager if name not in _CONDA_DEPENDENCIES else "conda"
 
-            if not spec.channels and dep.manager == "conda":
-                dep.conda_channel = dep.conda_channel or "conda-forge"
+            if needs_default_channel and dep.manager == "conda" and not dep.conda_channel:
+                dep.conda_channel = "conda-forge"
 
         spec.sources = []
         return spec
 
+    @property
+    def dependency_spec(self) -> "LockSpecification":
+        """Generate the dependency specification"""
+        # Only re-parse when the toolset definition or its file changes. conda-lock mutates
+        # the specs it's given, so callers always receive a copy of the cached spec
+        stat = os.stat(self.file) if self.file else None
+        cache_key = (
+            self.manager,
+            tuple(self.tools),
+            self.file,
+            stat.st_mtime_ns if stat else None,
+            stat.st_size if stat else None,
+        )
+        if not self._dependency_spec_cache or self._dependency_spec_cache[0] != cache_key:
+            # Parsing temporarily patches conda-lock module globals, so only one thread may
+            # parse at a time. Threads that waited on the lock reuse the spec parsed before them
+            with _dependency_spec_lock:
+                if not self._dependency_spec_cache or self._dependency_spec_cache[0] != cache_key:
+                    self._dependency_spec_cache = (cache_key, self._parse_dependency_spec())
+
+        return self._dependency_spec_cache[1].copy(deep=True)
+
     @classmethod
-    def from_def(cls, toolset):
+    def from_def(cls, toolset: dict) -> "Toolset":
         return cls(
             tools=toolset.get("tools", []),
             manager=toolset["manager"],
@@ -86,49 +198,74 @@ class Toolset:
         )
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(**_dataclass_kwargs)
 class Toolkit:
     name: str
     toolsets: typing.List[Toolset] = dataclasses.field(default_factory=list)
     base: typing.Optional["Toolkit"] = None
     platforms: typing.List[str] = dataclasses.field(default_factory=list)
     category: str = "dev"
-    _def: dict = None
+    _def: typing.Optional[dict] = None
+    _ref_cache: typing.Optional[tuple] = dataclasses.field(
+        default=None, init=False, repr=False, compare=False
+    )
 
     @property
-    def uri(self):
+    def uri(self) -> str:
         return f"toolkit:{self.name}"
 
-    def __post_init__(self):
+    def __post_init__(self) -> None:
         self.platforms = self.platforms or [
             "osx-arm64",
             "linux-aarch64",
         ]  # , "osx-64", "linux-64"]
 
+    def _ref_cache_key(self, files: typing.List[str], stats: typing.List[os.stat_result]) -> tuple:
+        """Key the cached ref on the definitions, platforms, and file stats"""
+        return (
+            tuple(self.platforms),
+            tuple(id(toolkit._def) for toolkit in self.flattened_toolkits),
+            tuple((file, stat.st_mtime_ns, stat.st_size) for file, stat in zip(files, stats)),
+        )
+
     @property
-    def ref(self):
+    def ref(self) -> str:
+        files = [toolset.file for toolset in self.flattened_toolsets if toolset.file]
+        stats = [os.stat(file) for file in files]
+        cache_key = self._ref_cache_key(files, stats)
+        if self._ref_cache and self._ref_cache[0] == cache_key:
+            return self._ref_cache[1]
+
         definitions = [
-            yaml.dump(toolkit._def, Dumper=yaml.SafeDumper) for toolkit in self.flattened_toolkits
+            yaml.dump(toolkit._def, Dumper=SafeDumper) for toolkit in self.flattened_toolkits
         ]
-        files = [toolset.file for toolset in self.flattened_toolsets if toolset.file]
 
-        h = hashlib.sha256()
+        # The ref is a content address, not a security primitive, so use the faster BLAKE2b
+        h = _blake2b()
         for platform in self.platforms:
             h.update(platform.encode("utf-8"))
 
         for definition in definitions:
             h.update(definition.encode("utf-8"))
 
-        for file in files:
-            with open(file, "rb") as f:
-                h.update(f.read())
+        # Digest large files concurrently. hashlib releases the GIL while hashing, so reads
+        # and hashing overlap across threads. Digests are combined in declaration order
+        if len(files) > 1 and sum(stat.st_size for stat in stats) >= _PARALLEL_DIGEST_MIN_BYTES:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(files))) as executor:
+                file_digests = list(executor.map(_file_digest, files))
+        else:
+            file_digests = [_file_digest(file) for file in files]
+
+        for file_digest in file_digests:
+            h.update(file_digest)
 
-        return h.hexdigest()
+        self._ref_cache = (cache_key, h.hexdigest())
+        return self._ref_cache[1]
 
     @property
-    def conda_env_name(self):
+    def conda_env_name(self) -> str:
         """The conda environment name"""
-        config = footing.util.local_config()
+        config = _local_config()
         name = config["project"]["name"]
 
         if self.name != "default":
@@ -137,50 +274,50 @@ class Toolkit:
         return name
 
     @property
-    def flattened_toolkits(self):
+    def flattened_toolkits(self) -> typing.List["Toolkit"]:
         """Generate a flattened list of all toolkits"""
         toolkits = []
-        if self.base:
-            toolkits.extend(self.base.flattened_toolkits)
-
-        toolkits.extend([self])
+        toolkit: typing.Optional[Toolkit] = self
+        while toolkit is not None:
+            toolkits.append(toolkit)
+            toolkit = toolkit.base
 
+        toolkits.reverse()
         return toolkits
 
     @property
-    def flattened_toolsets(self):
+    def flattened_toolsets(self) -> typing.List[Toolset]:
         """Generate a flattened list of all toolsets"""
-        toolsets = []
-
-        if self.base:
-            toolsets.extend(self.base.flattened_toolsets)
-
-        toolsets.extend(self.toolsets)
-
-        return toolsets
+        return [toolset for toolkit in self.flattened_toolkits for toolset in toolkit.toolsets]
 
     @property
-    def dependency_specs(self):
+    def dependency_specs(self) -> typing.List["LockSpecification"]:
         """Return dependency specs from all toolsets"""
-        specs = [toolset.dependency_spec for toolset in self.flattened_toolsets]
-        dependencies = (dependency for spec in specs for dependency in spec.dependencies)
+        from conda_lock.src_parser import LockSpecification
 
-        python_dep = pip_dep = None
-        has_pip_dependencies = False
-        for dependency in dependencies:
-            if dependency.name == "python":
-                python_dep = dependency
-            elif dependency.name == "pip":
-                pip_dep = dependency
+        specs = [toolset.dependency_spec for toolset in self.flattened_toolsets]
 
-            if dependency.manager == "pip":
-                has_pip_dependencies = True
+        # Scan flat lists of the only attributes we need rather than looking them up on
+        # every dependency object
+        dependencies = [dependency for spec in specs for dependency in spec.dependencies]
+        names = [dependency.name for dependency in dependencies]
+        managers = [dependency.manager for dependency in dependencies]
 
         # If python exists and we have pip dependencies without pip, install pip
-        if python_dep and not pip_dep and has_pip_dependencies:
-            pip_dep = copy.deepcopy(python_dep)
-            pip_dep.name = "pip"
-            pip_dep.version = "22.3.1"
+        if "python" in names and "pip" not in names and "pip" in managers:
+            python_dep = dependencies[names.index("python")]
+
+            # Dependencies are pydantic models. A shallow copy with updated fields avoids
+            # the overhead of deep copying the entire model. Mutable fields are copied
+            # explicitly since conda-lock merges selectors in place
+            pip_dep = python_dep.copy(
+                update={
+                    "name": "pip",
+                    "version": "22.3.1",
+                    "extras": list(python_dep.extras),
+                    "selectors": python_dep.selectors.copy(deep=True),
+                }
+            )
 
             specs.extend(
                 [LockSpecification(channels=[], dependencies=[pip_dep], platforms=[], sources=[])]
@@ -189,7 +326,9 @@ class Toolkit:
         return specs
 
     @classmethod
-    def from_def(cls, toolkit):
+    def from_def(
+        cls, toolkit: dict, by_name: typing.Optional[typing.Dict[str, dict]] = None
+    ) -> "Toolkit":
         toolsets = []
         if toolkit.get("toolsets"):
             toolsets.extend([Toolset.from_def(toolset) for toolset in toolkit["toolsets"]])
@@ -200,117 +339,138 @@ class Toolkit:
             name=toolkit["name"],
             category=toolkit.get("category", "dev"),
             toolsets=toolsets,
-            base=Toolkit.from_name(toolkit["base"]) if toolkit.get("base") else None,
+            base=Toolkit.from_name(toolkit["base"], by_name=by_name)
+            if toolkit.get("base")
+            else None,
             _def=toolkit,
         )
 
     @classmethod
-    def from_name(cls, name):
-        config = footing.util.local_config()
+    def from_name(
+        cls, name: str, by_name: typing.Optional[typing.Dict[str, dict]] = None
+    ) -> typing.Optional["Toolkit"]:
+        if by_name is None:
+            by_name = _toolkits_by_name(_local_config())
 
-        for toolkit in config["toolkits"]:
-            if toolkit["name"] == name:
-                return cls.from_def(toolkit)
+        toolkit = by_name.get(name)
+        return cls.from_def(toolkit, by_name=by_name) if toolkit else None
 
     @classmethod
-    def from_default(cls):
-        config = footing.util.local_config()
+    def from_default(cls) -> typing.Optional["Toolkit"]:
+        config = _local_config()
         num_public_toolkits = 0
 
-        name = None
+        public_toolkit = None
         for toolkit in config["toolkits"]:
             if toolkit["name"] == "default":
-                name = "default"
-                break
+                return cls.from_def(toolkit, by_name=_toolkits_by_name(config))
             elif not toolkit["name"].startswith("_"):
-                name = toolkit["name"]
+                public_toolkit = toolkit
                 num_public_toolkits += 1
-        else:
-            if num_public_toolkits != 1:
-                return None
 
-        return cls.from_name(name)
+        # Without a "default" toolkit, only fall back when there is one unambiguous choice
+        if public_toolkit is None or num_public_toolkits != 1:
+            return None
+
+        return cls.from_def(public_toolkit, by_name=_toolkits_by_name(config))
+
+    def lock(self, output_path: typing.Union[str, pathlib.Path]) -> None:
+        import conda_lock.conda_lock
+        from conda_lock.src_parser.lockfile import parse_conda_lock_file, write_conda_lock_file
+        from conda_lock.src_parser import pyproject_toml
+
+        # Parse the specs once in this thread. Parsing patches conda-lock module globals,
+        # which isn't safe to do from the locking threads. conda-lock also mutates the specs
+        # it's given, so each call gets its own copy
+        specs = self.dependency_specs
 
-    def lock(self, output_path):
         def _parse_source_files(*args, **kwargs):
-            return self.dependency_specs
+            return [spec.copy(deep=True) for spec in specs]
 
         with contextlib.ExitStack() as stack:
             stack.enter_context(
-                unittest.mock.patch(
-                    "conda_lock.conda_lock.parse_source_files", side_effect=_parse_source_files
+                footing.util.patch_attr(
+                    conda_lock.conda_lock, "parse_source_files", _parse_source_files
                 )
             )
-            stack.enter_context(unittest.mock.patch("sys.exit"))
+            stack.enter_context(footing.util.patch_attr(sys, "exit", _noop))
 
             # Retrieve the lookup table since it's patched
             pyproject_toml.get_lookup()
 
-            # Run the actual locking function
-            lock_args = [
-                "--lockfile",
-                str(output_path),
-                "--mamba",
-                "--strip-auth",
-                "--conda",
-                str(footing.util.condabin_dir() / "mamba"),
-            ]
-            for platform in self.platforms:
-                lock_args.extend(["-p", platform])
-
-            conda_lock.conda_lock.lock(lock_args)
-
-    def install(self):
+            # Lock each platform in parallel. The solver runs in a mamba subprocess, so
+            # threads are enough to overlap the work
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                platform_lock_paths = [
+                    pathlib.Path(tmp_dir) / f"{platform}.conda-lock.yml"
+                    for platform in self.platforms
+                ]
+                with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=len(self.platforms)
+                ) as executor:
+                    list(executor.map(_lock_platform, self.platforms, platform_lock_paths))
+
+                lockfile = functools.reduce(
+                    operator.or_,
+                    (parse_conda_lock_file(path) for path in platform_lock_paths),
+                )
+                write_conda_lock_file(lockfile, pathlib.Path(output_path), metadata_choices=None)
+
+    def install(self) -> "footing.registry.Package":
+        import conda_lock.conda_lock
+
         local_registry = footing.registry.local()
         repo_registry = footing.registry.repo()
         build_kwargs = {"ref": self.ref, "name": self.name}
 
-        lock_build_kwargs = {"kind": "toolkit-lock", **build_kwargs}
-        lock_package = repo_registry.find(**lock_build_kwargs)
-        if not lock_package:
-            local_lock_package = local_registry.find(**lock_build_kwargs)
-            if local_lock_package:
-                # Handle the case where a local lock file might be avaiable
-                with tempfile.NamedTemporaryFile() as tmp_file:
-                    local_lock_build = local_lock_package.pull(tmp_file.name)
-                    lock_package = repo_registry.push(local_lock_build)
-            else:
-                # TODO: Refactor this into build system
-                with tempfile.TemporaryDirectory() as tmp_dir:
-                    lock_file_path = pathlib.Path(tmp_dir) / "conda-lock.yml"
+        # TODO: Refactor this into build system
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # The lock file is materialized at most once and shared by the registries and
+            # the installer
+            lock_file_path = pathlib.Path(tmp_dir) / "conda-lock.yml"
+            lock_build = None
+
+            lock_build_kwargs = {"kind": "toolkit-lock", **build_kwargs}
+            lock_package = repo_registry.find(**lock_build_kwargs)
+            if not lock_package:
+                local_lock_package = local_registry.find(**lock_build_kwargs)
+                if local_lock_package:
+                    # Handle the case where a local lock file might be avaiable
+                    lock_build = local_lock_package.pull(lock_file_path)
+                    lock_package = repo_registry.push(lock_build)
+                else:
                     # We need to re-compute the lock
                     self.lock(lock_file_path)
                     lock_build = footing.build.Build(path=lock_file_path, **lock_build_kwargs)
                     local_registry.push(lock_build)
                     lock_package = repo_registry.push(lock_build)
 
-        toolkit_build_kwargs = {"kind": "toolkit", **build_kwargs}
-        toolkit_package = local_registry.find(**toolkit_build_kwargs)
-        if not toolkit_package:
-            # TODO: Refactor this into build system
-            with contextlib.ExitStack() as stack:
-                stack.enter_context(unittest.mock.patch("sys.exit"))
-                tmp_dir = stack.enter_context(tempfile.TemporaryDirectory())
-                tmp_lock_file = pathlib.Path(tmp_dir) / "conda-lock.yml"
-                # TODO: We assume the lock build's URI is a file path that can be directly opened.
-                # This assumption is safe to make with filesystem registries, but we should
-                # abstract this under the Build class
-                lock_package.pull(tmp_lock_file)
-                install_args = ["--name", self.conda_env_name, str(tmp_lock_file)]
+            toolkit_build_kwargs = {"kind": "toolkit", **build_kwargs}
+            toolkit_package = local_registry.find(**toolkit_build_kwargs)
+            if not toolkit_package:
+                if not lock_build:
+                    # TODO: We assume the lock build's URI is a file path that can be directly
+                    # opened. This assumption is safe to make with filesystem registries, but we
+                    # should abstract this under the Build class
+                    lock_package.pull(lock_file_path)
+
+                install_args = ["--name", self.conda_env_name, str(lock_file_path)]
                 if self.category != "dev":
                     install_args.extend(["--no-dev"])
 
-                conda_lock.conda_lock.install(install_args)
+                with footing.util.patch_attr(sys, "exit", _noop):
+                    conda_lock.conda_lock.install(install_args)
+
                 if self.category == "dev":
                     footing.util.conda_run("pip install -e .", toolkit=self)
 
-            toolkit_package = local_registry.push(
-                footing.build.Build(
-                    path=(footing.util.conda_dir() / "envs" / self.conda_env_name).resolve(),
-                    **toolkit_build_kwargs,
-                ),
-                copy=False,
-            )
+                toolkit_package = local_registry.push(
+                    footing.build.Build(
+                        path=(footing.util.conda_dir() / "envs" / self.conda_env_name).resolve(),
+                        **toolkit_build_kwargs,
+                    ),
+                    copy=False,
+                )
 
         return toolkit_package
 
@@ -323,7 +483,7 @@ def get(name=None):
 
 
 def ls(active=False):
-    config = footing.util.local_config()
+    config = _local_config()
 
     if active:
         name = footing.settings.get("toolkit")
@@ -332,8 +492,9 @@ def ls(active=False):
         else:
             return []
     else:
+        by_name = _toolkits_by_name(config)
         return [
-            Toolkit.from_def(toolkit)
+            Toolkit.from_def(toolkit, by_name=by_name)
             for toolkit in config["toolkits"]
             if not toolkit["name"].startswith("_")
         ]
@@ -174,6 +174,17 @@ def git(cmd, check=True, stdin=None, stdout=None, stderr=None, cwd=None):
     )
 
 
+@contextlib.contextmanager
+def patch_attr(obj, name, value):
+    """A context manager for temporarily replacing an attribute of an object or module"""
+    old_value = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, old_value)
+
+
 @contextlib.contextmanager
 def cd(path):
     """A context manager for changing into a directory"""